@@ -11,6 +11,7 @@ requirements: WDoc
 from typing import List, Union, Generator, Iterator
 from schemas import OpenAIChatMessage
 import os
+import asyncio
 
 from pydantic import BaseModel
 
@@ -41,7 +42,9 @@ class Pipeline:
         except Exception as err:
             raise Exception(f"Failed to import WDoc: '{err}'")
         try:
-            self.wdoc = WDoc(
+            # loading WDoc is slow and blocking, keep the event loop free
+            self.wdoc = await asyncio.to_thread(
+                WDoc,
                 task="query",
                 import_mode=True,
                 query="this is a test",
@@ -11,6 +11,14 @@ funding_url: https://github.com/open-webui/pipelines/discussions/198#discussionc
 from typing import List, Optional
 from pydantic import BaseModel, Field
 import json
+from copy import deepcopy
+from functools import cache
+
+
+@cache
+def load_json(value: str):
+    "parse a json valve, cached as valves are parsed on every inlet"
+    return json.loads(value)
 
 
 class Pipeline:
@@ -48,7 +56,7 @@ class Pipeline:
         print(f"on_valves_updated:{__name__}")
         if isinstance(self.valves.extra_metadata, str):
             try:
-                json.loads(self.valves.extra_metadata)
+                load_json(self.valves.extra_metadata)
             except Exception as err:
                 raise Exception(f"Failed to parse extra_metadata as json dict: '{err}'")
 
@@ -84,20 +92,25 @@ class Pipeline:
 
         # add missing tags
         if self.valves.tags.strip():
+            tags = load_json(self.valves.tags)
             if "tags" in body["custom_metadata"]:
-                for t in json.loads(self.valves.tags):
+                for t in tags:
                     if t not in body["custom_metadata"]["tags"]:
                         body["custom_metadata"]["tags"].append(t)
             else:
-                body["custom_metadata"]["tags"] = self.valves.tags
+                # copied as the cached list must not be modified
+                body["custom_metadata"]["tags"] = list(tags)
             body["custom_metadata"]["tags"] = sorted(body["custom_metadata"]["tags"])
 
         # add extra metadata
         if self.valves.extra_metadata.strip():
-            em = json.loads(self.valves.extra_metadata)
+            em = load_json(self.valves.extra_metadata)
             for k, v in em.items():
                 if k in body["custom_metadata"] and v != body["custom_metadata"][k]:
                     print(f"Error: extra_metadata '{k}' is already present and of different value")
+                # lists and dicts are copied as the cached values must not be modified
+                if isinstance(v, (list, dict)):
+                    v = deepcopy(v)
                 body["custom_metadata"][k] = v
 
         return body
@@ -40,8 +40,11 @@ class Pipeline:
                 "LITELLM_PIPELINE_DEBUG": os.getenv("LITELLM_PIPELINE_DEBUG", True),
             }
         )
-        # Get models on initialization
-        self.pipelines = self.get_litellm_models()
+        # kept for the life of the pipeline to reuse connections to litellm
+        self.session = requests.Session()
+
+        # models are fetched in on_startup, once the saved valves are loaded
+        self.pipelines = []
         pass
 
     async def on_startup(self):
@@ -49,12 +52,11 @@ class Pipeline:
         print(f"on_startup:{__name__}")
         # Get models on startup
         self.pipelines = self.get_litellm_models()
-        pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
         print(f"on_shutdown:{__name__}")
-        pass
+        self.session.close()
 
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
@@ -70,7 +72,7 @@ class Pipeline:
 
         if self.valves.LITELLM_BASE_URL:
             try:
-                r = requests.get(
+                r = self.session.get(
                     f"{self.valves.LITELLM_BASE_URL}/v1/models", headers=headers
                 )
                 models = r.json()
@@ -117,9 +119,10 @@ class Pipeline:
             if body.get('custom_metadata'):
                 payload["metadata"] = body["custom_metadata"]
 
-            print(json.dumps(payload))
+            if self.valves.LITELLM_PIPELINE_DEBUG:
+                print(json.dumps(payload))
 
-            r = requests.post(
+            r = self.session.post(
                 url=f"{self.valves.LITELLM_BASE_URL}/v1/chat/completions",
                 json=payload,
                 headers=headers,
@@ -68,9 +68,7 @@ class Filter:
             if isinstance(m["content"], str):
                 sys_prompt = m["content"]
             elif isinstance(m["content"], list):
-                sys_prompt = ""
-                for ii, mm in enumerate(m["content"]):
-                    sys_prompt += mm["text"]
+                sys_prompt = "".join(mm["text"] for mm in m["content"])
             elif isinstance(m["content"], dict):
                 sys_prompt = m["content"]["text"]
             else:
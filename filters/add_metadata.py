@@ -135,7 +135,8 @@ class Filter:
         # also add as langfuse metadata
         body["metadata"]["trace_metadata"] = body["metadata"].copy()
 
-        await log(json.dumps(body))
+        if self.valves.debug:
+            await log(json.dumps(body))
         await emitter.success_update("")  # hides the emitter
         return body
 
@@ -146,6 +147,10 @@ class Filter:
 class EventEmitter:
     def __init__(self, event_emitter: Callable[[dict], Any] = None):
         self.event_emitter = event_emitter
+        # the same event is updated and sent each time, this is safe as
+        # each emit is awaited before the next one
+        self.status = {"status": "in_progress", "description": "", "done": False}
+        self.event = {"type": "status", "data": self.status}
 
     async def progress_update(self, description):
         await self.emit(description)
@@ -158,14 +163,8 @@ class EventEmitter:
 
     async def emit(self, description="Unknown State", status="in_progress", done=False):
         if self.event_emitter:
-            await self.event_emitter(
-                {
-                    "type": "status",
-                    "data": {
-                        "status": status,
-                        "description": description,
-                        "done": done,
-                    },
-                }
-            )
+            self.status["status"] = status
+            self.status["description"] = description
+            self.status["done"] = done
+            await self.event_emitter(self.event)
 
@@ -13,6 +13,25 @@ import re
 from pydantic import BaseModel, Field
 from typing import Optional
 
+REGEX_SPECIAL_CHARS = ".^$*+?{}[]|()\\"
+
+
+def literal_prefix(pattern: str) -> str:
+    """Return the literal string any match of the regex pattern has to start
+    with. Used as a cheap substring check before running the regexes.
+    Returns an empty string when no such prefix can be determined."""
+    if "|" in pattern:
+        return ""
+    pattern = pattern.lstrip("^")  # zero width
+    prefix = ""
+    for char in pattern:
+        if char in REGEX_SPECIAL_CHARS:
+            if char in "*?{":  # the quantifier applies to the last char
+                prefix = prefix[:-1]
+            break
+        prefix += char
+    return prefix
+
 
 class Filter:
     class Valves(BaseModel):
@@ -40,12 +59,17 @@ class Filter:
             flags=re.DOTALL | re.MULTILINE,
         )
         self.converted_pattern = re.compile(r"<details>\s*<summary>Reasonning</summary>.*?</details>", flags=re.DOTALL | re.MULTILINE)
+        # most messages contain no thought, those are skipped without regex
+        self.anchor = literal_prefix(self.valves.start_thought)
         self.p("Init:done")
         pass
 
     def remove_thought(self, text: str) -> str:
         "remove thoughts"
         self.p("remove_thought: start")
+        if self.anchor and self.anchor not in text and "<details>" not in text:
+            self.p("remove_thought: No thought to remove in text")
+            return text
         if not (self.pattern.search(text) or self.converted_pattern.search(text)):
             self.p("remove_thought: No thought to remove in text")
             return text
@@ -60,6 +84,9 @@ class Filter:
     def hide_thought(self, text: str) -> str:
         "put the thoughts in <details> tags"
         self.p("hide_thought: start")
+        if self.anchor and self.anchor not in text:
+            self.p("hide_thought: No thought to hide in text")
+            return text
         match = self.pattern.search(text)
         if not match:
             self.p("hide_thought: No thought to hide in text")
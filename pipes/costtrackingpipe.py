@@ -11,16 +11,48 @@ description: A pipe function to track user costs and remove 'thinking' blocks
 
 from typing import List, Union, Generator, Iterator, Callable, Any, Optional
 from pydantic import BaseModel, Field
-import requests
+import aiohttp
+import asyncio
 import os
 import re
 import time
 import json
+from functools import cache
+
+try:
+    # faster json parser, its JSONDecodeError subclasses json's
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 DEFAULT_BASE_URL = "http://127.0.0.1:4000"
 DEFAULT_CHAT_MODEL = "litellm_sonnet-3.5"
 DEFAULT_TITLE_CHAT_MODEL = "litellm_gpt-4o-mini"
 
+THOUGHT_PATTERN = re.compile(r"``` ?thinking.*?```", re.DOTALL)
+
+# tasks closing the http sessions of discarded pipes, referenced here
+# until they are done so that they are not garbage collected
+CLOSING_TASKS = set()
+
+
+@cache
+def load_api_keys(api_keys: str) -> dict:
+    "parse the api_keys valve, cached as it is needed for every request"
+    assert isinstance(
+        api_keys, str
+    ), f"Expected api_keys to be a str at this point, not {type(api_keys)}"
+    try:
+        api_keys = json.loads(api_keys)
+        assert isinstance(
+            api_keys, dict
+        ), f"Expected api_keys to be a dict at this point, not {type(api_keys)}"
+    except Exception as err:
+        raise Exception(f"Error when casting api_keys from str to dict: '{err}'")
+
+    assert "default" in api_keys, f"No 'default' key found in dict: {api_keys}"
+    return api_keys
+
 
 class Pipe:
 
@@ -71,9 +103,41 @@ class Pipe:
         # Initialize rate limits
         self.valves = self.Valves()
 
+        # created on first use and kept to reuse the connection to litellm
+        self.session = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        "return the http session shared by all calls to the pipe"
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                # http errors are raised as soon as the response is received
+                raise_for_status=True,
+                # answers can take long to stream so there is no overall
+                # timeout, but an unreachable litellm fails fast
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=10),
+            )
+        return self.session
+
+    def __del__(self):
+        """Close the http session. Open WebUI has no hook for when a
+        function is reloaded or removed, the old pipe is just dropped."""
+        session = getattr(self, "session", None)
+        if session is None or session.closed:
+            return
+        try:
+            task = asyncio.get_running_loop().create_task(session.close())
+        except RuntimeError:  # no event loop anymore, e.g. at exit
+            return
+        CLOSING_TASKS.add(task)
+        task.add_done_callback(CLOSING_TASKS.discard)
+
     async def on_valves_updated(self):
         """This function is called when the valves are updated."""
         # just checking the validity of the api_keys
+        self.get_api_keys()
+
+    def get_api_keys(self) -> dict:
+        "load the api_keys as a dict, from the valve or the env variable"
         if self.valves.api_keys is None:
             assert (
                 "COSTTRACKINGPIPE_API_KEYS" in os.environ
@@ -81,18 +145,7 @@ class Pipe:
             api_keys = os.environ["COSTTRACKINGPIPE_API_KEYS"]
         else:
             api_keys = self.valves.api_keys
-        assert isinstance(
-            api_keys, str
-        ), f"Expected api_keys to be a str at this point, not {type(api_keys)}"
-        try:
-            api_keys = json.loads(api_keys)
-            assert isinstance(
-                api_keys, dict
-            ), f"Expected api_keys to be a dict at this point, not {type(api_keys)}"
-        except Exception as err:
-            raise Exception(f"Error when casting api_keys from str to dict: '{err}'")
-
-        assert "default" in api_keys, f"No 'default' key found in dict: {api_keys}"
+        return load_api_keys(api_keys)
 
     async def pipe(
         self,
@@ -103,35 +156,8 @@ class Pipe:
         *args,
         **kwargs,
     ) -> Union[str, Generator, Iterator]:
-        self.on_valves_updated()
-        self.start_thought = re.compile(__user__["valves"].start_thoughts)
-        self.stop_thought = re.compile(__user__["valves"].stop_thoughts)
-        self.pattern = re.compile(
-            __user__["valves"].start_thoughts + "(.*)?" + __user__["valves"].stop_thoughts,
-            flags=re.DOTALL | re.MULTILINE,
-        )
-
-
-        # load the api_keys as a dict
-        if self.valves.api_keys is None:
-            assert (
-                "COSTTRACKINGPIPE_API_KEYS" in os.environ
-            ), "You left the valve api_keys to None but didn't set an env variable COSTTRACKINGPIPE_API_KEYS"
-            api_keys = os.environ["COSTTRACKINGPIPE_API_KEYS"]
-        else:
-            api_keys = self.valves.api_keys
-        assert isinstance(
-            api_keys, str
-        ), f"Expected api_keys to be a str at this point, not {type(api_keys)}"
-        try:
-            api_keys = json.loads(api_keys)
-            assert isinstance(
-                api_keys, dict
-            ), f"Expected api_keys to be a dict at this point, not {type(api_keys)}"
-        except Exception as err:
-            raise Exception(f"Error when casting api_keys from str to dict: '{err}'")
-
-        assert "default" in api_keys, f"No 'default' key found in dict: {api_keys}"
+        # load the api_keys as a dict, this also checks their validity
+        api_keys = self.get_api_keys()
 
         # prints and emitter to show progress
         def pprint(message: str) -> str:
@@ -181,36 +207,36 @@ class Pipe:
                 # raise Exception(f"User not found: {username}")
         body["user"] = username
 
+        r = None
         try:
             if body["stream"]:
                 model = __user__["valves"].chat_model
             else:
                 # stream disabled is only used for the summary title creator AFAIK
                 model = __user__["valves"].title_chat_model
-            payload = {**body, "model": model, "user": username}
+            # body already has the user set above, no need to copy it
+            body["model"] = model
 
             await prog("Waiting for response")
-            r = requests.post(
+            # the headers differ per user, they are not set on the session
+            r = await self.get_session().post(
                 url=f"{self.valves.LITELLM_BASE_URL}/v1/chat/completions",
-                json=payload,
+                json=body,
                 headers=headers,
-                stream=True,
             )
-
-            r.raise_for_status()
-            assert r.status_code == 200, f"Invalid status code: {r.status_code}"
+            assert r.status == 200, f"Invalid status code: {r.status}"
 
             if body["stream"]:
                 await prog("Receiving chunks")
                 if (not __user__["valves"].remove_thoughts) or (not __user__["valves"].enabled):
-                    for line in r.iter_lines():
-                        yield line
+                    async for line in r.content:
+                        yield line.rstrip(b"\r\n")
                     return
                 buffer = ""
-                thought_pattern = re.compile(r"``` ?thinking.*?```", re.DOTALL)
                 thought_removed = False
 
-                for line in r.iter_lines():
+                async for line in r.content:
+                    line = line.rstrip(b"\r\n")
                     if (
                         not __user__["valves"].debug
                         and "start_time" in locals()
@@ -219,13 +245,13 @@ class Pipe:
                         # remove this print after 1s
                         await succ("")
                     if line:
-                        line = line.decode("utf-8")
-                        if line.startswith("data: "):
+                        # stays in bytes: both json parsers accept them directly
+                        if line.startswith(b"data: "):
                             line = line[6:]  # Remove "data: " prefix
-                        if line.strip() == "[DONE]":
+                        if line.strip() == b"[DONE]":
                             break
                         try:
-                            parsed_line = json.loads(line)
+                            parsed_line = json_loads(line)
                         except (json.JSONDecodeError, KeyError):
                             continue
 
@@ -237,7 +263,10 @@ class Pipe:
                             yield content
                             continue
                         buffer += content
-                        match = thought_pattern.search(buffer)
+                        if "```" not in buffer:
+                            # cheap check: no thought block can be there yet
+                            continue
+                        match = THOUGHT_PATTERN.search(buffer)
                         if match:
                             # Remove the thought block
                             buffer = buffer[: match.start()] + buffer[match.end() :]
@@ -258,7 +287,7 @@ class Pipe:
 
             else:  # return the whole text directly
                 await prog("Returning directly")
-                j = r.json()
+                j = json_loads(await r.read())
                 to_yield = j["choices"][0]["message"].get("content", "")
                 yield to_yield
 
@@ -270,10 +299,19 @@ class Pipe:
             await err(f"Error: {e}")
             raise
 
+        finally:
+            if r is not None:
+                # gives the connection back to the session
+                r.release()
+
 
 class EventEmitter:
     def __init__(self, event_emitter: Callable[[dict], Any] = None):
         self.event_emitter = event_emitter
+        # the same event is updated and sent each time, this is safe as
+        # each emit is awaited before the next one
+        self.status = {"status": "in_progress", "description": "", "done": False}
+        self.event = {"type": "status", "data": self.status}
 
     async def progress_update(self, description):
         await self.emit(description)
@@ -286,14 +324,8 @@ class EventEmitter:
 
     async def emit(self, description="Unknown State", status="in_progress", done=False):
         if self.event_emitter:
-            await self.event_emitter(
-                {
-                    "type": "status",
-                    "data": {
-                        "status": status,
-                        "description": description,
-                        "done": done,
-                    },
-                }
-            )
+            self.status["status"] = status
+            self.status["description"] = description
+            self.status["done"] = done
+            await self.event_emitter(self.event)
 
@@ -9,16 +9,82 @@ license: GPLv3
 description: A pipe function that automatically replaces <thinking> xml tags to display as <details>
 """
 
-from typing import Union, Generator, Iterator, Callable, Any, Optional
-from pydantic import BaseModel, Field
-import requests
+from typing import List, Union, Generator, Iterator, Callable, Any, Optional, Tuple
+from pydantic import BaseModel, Field, model_validator
+import aiohttp
+import asyncio
+import logging
 import re
 import json
+from functools import lru_cache
+
+try:
+    import re2  # linear time regex engine, used if installed
+except ImportError:
+    re2 = None
+
+try:
+    # faster json parser, its JSONDecodeError subclasses json's
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+logger = logging.getLogger("RemoveThinkingPipe")
 
 DEFAULT_BASE_URL = "http://127.0.0.1:4000"
 DEFAULT_CHAT_MODEL = "litellm_sonnet-3.5"
 DEFAULT_TITLE_CHAT_MODEL = "litellm_gpt-4o-mini"
 
+SLEEP_EVERY_N_TOKENS = 16  # give back control to the event loop that often
+REGEX_SPECIAL_CHARS = ".^$*+?{}[]|()\\"
+
+# tasks closing the http sessions of discarded pipes, referenced here
+# until they are done so that they are not garbage collected
+CLOSING_TASKS = set()
+
+
+def literal_prefix(pattern: str) -> str:
+    """Return the literal string any match of the regex pattern has to start
+    with. Used as a cheap str.find check before running the regexes.
+    Returns an empty string when no such prefix can be determined."""
+    if "|" in pattern:
+        return ""
+    pattern = pattern.lstrip("^")  # zero width
+    prefix = ""
+    for char in pattern:
+        if char in REGEX_SPECIAL_CHARS:
+            if char in "*?{":  # the quantifier applies to the last char
+                prefix = prefix[:-1]
+            break
+        prefix += char
+    return prefix
+
+
+def compile_thought_pattern(start_thought: str, stop_thought: str):
+    """Compile the pattern matching a whole thought block. Uses re2 if
+    available and falls back to re if re2 is missing or does not support
+    the pattern (for example backreferences)."""
+    pattern = start_thought + "(.*)?" + stop_thought
+    if re2 is not None:
+        try:
+            return re2.compile("(?sm)" + pattern)
+        except Exception:
+            pass
+    return re.compile(pattern, flags=re.DOTALL | re.MULTILINE)
+
+
+@lru_cache(maxsize=8)
+def compile_thought_regexes(start_thought: str, stop_thought: str) -> tuple:
+    """Return the start, stop and whole thought regexes and the literal
+    prefix of start_thought. Memoized on the valve values because the
+    pipe reads its valves on every call."""
+    return (
+        re.compile(start_thought),
+        re.compile(stop_thought),
+        compile_thought_pattern(start_thought, stop_thought),
+        literal_prefix(start_thought),
+    )
+
 
 class Pipe:
 
@@ -50,6 +116,19 @@ class Pipe:
             default=True,
             description="Wether to cache the system prompt, if using a claude model",
         )
+        thought_producing_models: List[str] = Field(
+            default=[],
+            description="If not empty and none of those strings is in the name of chat_model, the model is assumed to never produce thought blocks and its answer is streamed as is. Leave empty to look for thoughts with any model",
+        )
+
+        @model_validator(mode="after")
+        def check_thought_regexes(self):
+            "invalid regexes are refused when saving the valves instead of failing the next chat"
+            try:
+                compile_thought_regexes(self.start_thought, self.stop_thought)
+            except re.error as e:
+                raise ValueError(f"Invalid start_thought or stop_thought regex: {e}")
+            return self
 
     class UserValves(BaseModel):
         remove_thoughts: bool = Field(
@@ -67,40 +146,81 @@ class Pipe:
         # Initialize rate limits
         self.valves = self.Valves()
 
-        self.start_thought = re.compile(
-            self.valves.start_thought + r"\s*",
-            flags=re.DOTALL | re.MULTILINE,
-        )
-        self.stop_thought = re.compile(
-            "r\s*" + self.valves.stop_thought,
-            flags=re.DOTALL |re.MULTILINE
-        )
-        self.pattern = re.compile(
-            self.valves.start_thought + "(.*)?" + self.valves.stop_thought,
-            flags=re.DOTALL | re.MULTILINE,
-        )
+        # created on first use and kept to reuse the connection to litellm
+        self.session = None
+        # valve values update_valves last ran with, it derives all the
+        # valve dependent attributes at the start of each call
+        self.valves_sig = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        "return the http session shared by all calls to the pipe"
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                # http errors are raised as soon as the response is received
+                raise_for_status=True,
+                # answers can take long to stream so there is no overall
+                # timeout, but an unreachable litellm fails fast
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=10),
+            )
+        return self.session
 
-    def p(self, message: str) -> str:
-        "simple printer"
-        print(f"{self.name}: {message}")
-        return message
+    def __del__(self):
+        """Close the http session. Open WebUI has no hook for when a
+        function is reloaded or removed, the old pipe is just dropped."""
+        session = getattr(self, "session", None)
+        if session is None or session.closed:
+            return
+        try:
+            task = asyncio.get_running_loop().create_task(session.close())
+        except RuntimeError:  # no event loop anymore, e.g. at exit
+            return
+        CLOSING_TASKS.add(task)
+        task.add_done_callback(CLOSING_TASKS.discard)
 
     def update_valves(self):
         """This function is called when the valves are updated."""
+        valves = self.valves
+
+        # also called for every request, nothing to do if no valve changed
+        valves_sig = (
+            valves.litellm_base_url,
+            valves.api_key,
+            valves.start_thought,
+            valves.stop_thought,
+            valves.chat_model,
+            tuple(valves.thought_producing_models),
+        )
+        if valves_sig == self.valves_sig:
+            return
+
         # just checking the validity of the api_key
-        api_key = self.valves.api_key
+        api_key = valves.api_key
         assert isinstance(
             api_key, str
         ), f"Expected api_key to be a str, not {type(api_key)}"
-        api_key = api_key.strip()
-        assert api_key, "Valve api_key is empty"
-
-        self.start_thought = re.compile(self.valves.start_thought)
-        self.stop_thought = re.compile(self.valves.stop_thought)
-        self.pattern = re.compile(
-            self.valves.start_thought + "(.*)?" + self.valves.stop_thought,
-            flags=re.DOTALL | re.MULTILINE,
+        assert api_key.strip(), "Valve api_key is empty"
+
+        # request url and headers only depend on the valves
+        self.completions_url = f"{valves.litellm_base_url}/v1/chat/completions"
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+        if self.session is not None:
+            self.session.headers.update(self.headers)
+
+        (
+            self.start_thought,
+            self.stop_thought,
+            self.pattern,
+            self.anchor,
+        ) = compile_thought_regexes(valves.start_thought, valves.stop_thought)
+        # tail of the buffer held back in case a thought starts in it
+        self.len_start_thought = int(1.5 * len(valves.start_thought))
+        # an empty list means any model can produce thoughts
+        chat_model = valves.chat_model.lower()
+        self.emits_thoughts = not valves.thought_producing_models or any(
+            t.lower() in chat_model for t in valves.thought_producing_models
         )
+        self.valves_sig = valves_sig
 
     async def pipe(
         self,
@@ -112,19 +232,22 @@ class Pipe:
         **kwargs,
     ) -> Union[str, Generator, Iterator]:
 
+        emitter = None
+        r = None
+
         # wrap the whole function into a try block to yield the exception
         try:
             self.update_valves()
+            valves = self.valves
+            user_valves = __user__["valves"]
 
-            apikey = self.valves.api_key
-
-            # prints and emitter to show progress
+            # logs and emitter to show progress
             def pprint(message: str) -> str:
-                self.p(f"'{__user__['name']}': {message}")
+                logger.info("%s: '%s': %s", self.name, __user__["name"], message)
                 return message
 
             emitter = EventEmitter(__event_emitter__)
-            clear_emitter = not __user__["valves"].debug
+            clear_emitter = not user_valves.debug
             latest_message = ""
 
             async def prog(message: str) -> None:
@@ -156,27 +279,24 @@ class Pipe:
                 if kwargs:
                     pprint("Received kwargs:" + str(kwargs))
 
-            if __user__["valves"].debug:
+            if user_valves.debug:
                 pprint(body.keys())
                 pprint(body)
 
             if body["stream"]:
-                model = self.valves.chat_model
+                model = valves.chat_model
                 title = False
                 user = f"{__user__['name']}_{__user__['email']}"
             else:
                 # stream disabled is only used for the summary title creator AFAIK
                 title = True
-                model = self.valves.title_chat_model
+                model = valves.title_chat_model
                 user = f"titlecreator_{__user__['name']}_{__user__['email']}"
 
-            # claude prompt caching
-            can_be_cached = False
-            for w in ["anthropic", "claude", "haiku", "sonnet"]:
-                if w in model.lower():
-                    can_be_cached = True
-                    break
-            if self.valves.cache_system_prompt and can_be_cached:
+            # claude prompt caching, the model is only checked if enabled
+            if valves.cache_system_prompt and any(
+                w in model.lower() for w in ("anthropic", "claude", "haiku", "sonnet")
+            ):
                 pprint("Using anthropic's prompt caching")
                 for i, m in enumerate(body["messages"]):
                     if m["role"] != "system":
@@ -184,9 +304,7 @@ class Pipe:
                     if isinstance(m["content"], str):
                         sys_prompt = m["content"]
                     elif isinstance(m["content"], list):
-                        sys_prompt = ""
-                        for ii, mm in enumerate(m["content"]):
-                            sys_prompt += mm["text"]
+                        sys_prompt = "".join(mm["text"] for mm in m["content"])
                     elif isinstance(m["content"], dict):
                         sys_prompt = m["content"]["text"]
                     else:
@@ -206,114 +324,110 @@ class Pipe:
             else:
                 pprint("Anthropic caching will not be used for this call")
 
-            # match the api key
-            headers = {}
-            headers["Authorization"] = f"Bearer {apikey}"
-
-            payload = body.copy()
-            payload["model"] = model
+            # body is modified in place instead of copied, nested values
+            # included, the caller must not expect it to be left unchanged
+            body["model"] = model
 
             # also sets the user and if it's a titlecreator or not
-            if "user" not in body:
-                payload["user"] = user
-            elif payload["user"] in user:
-                payload["user"] = user
+            if "user" not in body or body["user"] in user:
+                body["user"] = user
 
-            if "metadata" in payload:
+            if "metadata" in body:
                 assert (
-                    "custom_metadata" not in payload
-                ), "Found metadata and custom_metadata in payload"
-                payload["custom_metadata"] = payload["metadata"]
-                del payload["metadata"]
+                    "custom_metadata" not in body
+                ), "Found metadata and custom_metadata in body"
+                body["custom_metadata"] = body.pop("metadata")
 
             if title:
-                if "custom_metadata" in payload:
-                    if "tags" in payload["custom_metadata"]:
+                if "custom_metadata" in body:
+                    if "tags" in body["custom_metadata"]:
                         assert isinstance(
-                            payload["custom_metadata"]["tags"], list
-                        ), f"payload['tags'] was not a list but '{type(payload['custom_metadata']['tags'])}"
-                        payload["custom_metadata"]["tags"].append("title_ceator")
+                            body["custom_metadata"]["tags"], list
+                        ), f"body['tags'] was not a list but '{type(body['custom_metadata']['tags'])}"
+                        body["custom_metadata"]["tags"].append("title_ceator")
                     else:
-                        payload["custom_metadata"]["tags"] = ["title_ceator"]
+                        body["custom_metadata"]["tags"] = ["title_ceator"]
                 else:
-                    payload["custom_metadata"] = {"tags": ["title_creator"]}
+                    body["custom_metadata"] = {"tags": ["title_creator"]}
 
             # add langfuse session_id
-            if "custom_metadata" in payload:
+            if "custom_metadata" in body:
                 if "session_id" not in body["custom_metadata"]:
                     body["custom_metadata"]["session_id"] = body["chat_id"]
                 elif body["custom_metadata"]["session_id"] != body["chat_id"]:
-                    print(
-                        f"Error: distinct 'session_id' found: '{body['custom_metadata']['session_id']}' in body and '{body['chat_id']}' in body. Keeping the later"
+                    logger.warning(
+                        "Error: distinct 'session_id' found: '%s' in body and '%s' in body. Keeping the later",
+                        body["custom_metadata"]["session_id"],
+                        body["chat_id"],
                     )
                     body["custom_metadata"]["session_id"] = body["chat_id"]
 
             await prog("Waiting for response")
             try:
-                r = requests.post(
-                    url=f"{self.valves.litellm_base_url}/v1/chat/completions",
-                    json=payload,
-                    headers=headers,
-                    stream=True,
+                r = await self.get_session().post(
+                    url=self.completions_url,
+                    json=body,
                 )
-                r.raise_for_status()
-            except Exception as e:
-                raise Exception(f"Error when creating requests: ") from e
-            assert r.status_code == 200, f"Invalid status code: {r.status_code}"
+            except aiohttp.ClientError as e:
+                raise Exception(f"Error when creating requests: {e}") from e
+            assert r.status == 200, f"Invalid status code: {r.status}"
 
             yielded = ""
 
             if not title:
                 await prog("Receiving chunks")
 
-                # disabled, return all directly
-                if not __user__["valves"].remove_thoughts:
-                    for line in r.iter_lines():
-                        try:
-                            content = self.parse_chunk(line)
-                        except Exception as e:
-                            es = str(e)
-                            if es == "DONE":
-                                break
-                            elif es == "CONTINUE":
-                                continue
-                            else:
-                                raise Exception("Error when parsing chunk: ") from e
+                tokens_since_sleep = 0
+
+                # disabled or the model never thinks, return all directly
+                if not (user_valves.remove_thoughts and self.emits_thoughts):
+                    async for line in r.content:
+                        content = self.parse_chunk(line)
+                        if content is None:
+                            break
+                        elif not content:
+                            continue
                         yielded += content
                         yield content
+
+                        tokens_since_sleep += 1
+                        if tokens_since_sleep >= SLEEP_EVERY_N_TOKENS:
+                            tokens_since_sleep = 0
+                            await asyncio.sleep(0)
                     if clear_emitter:
                         await succ("")  # hides it
                     return
 
                 buffer = ""
-                len_start_thought = int(1.5 * len(self.valves.start_thought))
+                len_start_thought = self.len_start_thought
 
                 # remove thoughts
                 thought_removed = 0
-                for line in r.iter_lines():
+                async for line in r.content:
                     if not line:
                         continue
 
-                    try:
-                        content = self.parse_chunk(line)
-                    except Exception as e:
-                        e = str(e)
-                        if e == "DONE":
-                            break
-                        elif e == "CONTINUE":
-                            continue
-                        else:
-                            raise
+                    content = self.parse_chunk(line)
+                    if content is None:
+                        break
+                    elif not content:
+                        continue
                     buffer += content
 
-                    match = self.pattern.search(buffer)
+                    tokens_since_sleep += 1
+                    if tokens_since_sleep >= SLEEP_EVERY_N_TOKENS:
+                        tokens_since_sleep = 0
+                        await asyncio.sleep(0)
+
+                    # no thought can start in the buffer if the literal
+                    # start of start_thought is absent, skip the regexes
+                    maybe_thought = not self.anchor or self.anchor in buffer
+
+                    match = self.pattern.search(buffer) if maybe_thought else None
                     if match:  # Remove the thought block
-                        section = match.group()
-                        bef, buffer = buffer.split(section, 1)
+                        bef, section, buffer = self.hide_thought(buffer, match)
                         yielded += bef
                         yield bef
-                        section = self.start_thought.sub("\n\n<details>\n<summary>Reasonning</summary>\n\n", section)
-                        section = self.stop_thought.sub("\n\n</details>\n", section)
                         yielded += section
                         yield section
                         thought_removed += 1
@@ -321,7 +435,7 @@ class Pipe:
 
                     if buffer:
                         # remove ulterior thought blocks
-                        start_match = self.start_thought.search(buffer)
+                        start_match = maybe_thought and self.start_thought.search(buffer)
                         if start_match:
                             await prog(
                                 f"Waiting for thought n°{thought_removed + 1} to finish"
@@ -337,12 +451,9 @@ class Pipe:
                 if buffer:  # Yield any remaining content with finish_reason "stop"
                     match = self.pattern.search(buffer)
                     if match:
-                        section = match.group()
-                        bef, buffer = buffer.split(section, 1)
+                        bef, section, buffer = self.hide_thought(buffer, match)
                         yielded += bef
                         yield bef
-                        section = self.start_thought.sub("\n\n<details>\n<summary>Reasonning</summary>\n\n", section)
-                        section = self.stop_thought.sub("\n\n</details>\n", section)
                         yielded += section
                         yield section
 
@@ -366,7 +477,7 @@ class Pipe:
 
             else:  # return the whole text directly
                 await prog("Returning directly")
-                j = r.json()
+                j = json_loads(await r.read())
                 to_yield = j["choices"][0]["message"].get("content", "")
                 yielded += to_yield
                 yield to_yield
@@ -384,16 +495,35 @@ class Pipe:
                 yield f"An error has occured:\n---\n{e}\n---"
             raise
 
-    def parse_chunk(self, line) -> str:
-        line = line.decode("utf-8")
-        if line.startswith("data: "):
+        finally:
+            if r is not None:
+                # gives the connection back to the session
+                r.release()
+
+            if emitter is not None:
+                await emitter.flush()
+
+    def hide_thought(self, buffer: str, match: re.Match) -> Tuple[str, str, str]:
+        """Split buffer around the matched thought block and turn the block
+        into a <details> section. Returns (before, section, after)."""
+        section = self.start_thought.sub("\n\n<details>\n<summary>Reasonning</summary>\n\n", match.group())
+        section = self.stop_thought.sub("\n\n</details>\n", section)
+        return buffer[:match.start()], section, buffer[match.end():]
+
+    def parse_chunk(self, line: bytes) -> Optional[str]:
+        """Parse a line of the streamed response, trailing newline included.
+        Called for every token so it does not rely on exceptions for control
+        flow: returns None when the stream is done and an empty string when
+        there is nothing to yield."""
+        # stays in bytes: both json parsers accept them directly
+        if line.startswith(b"data: "):
             line = line[6:]  # Remove "data: " prefix
-        if line.strip() == "[DONE]":
-            raise Exception("DONE")  # triggers a break
+        if line.strip() == b"[DONE]":
+            return None
         try:
-            parsed_line = json.loads(line)
+            parsed_line = json_loads(line)
         except (json.JSONDecodeError, KeyError):
-            raise Exception("CONTINUE")
+            return ""
 
         if (
             "error" in parsed_line
@@ -409,34 +539,78 @@ class Pipe:
                 f"KeyError for parsed_line: '{e}'.\nParsed_line: '{parsed_line}'"
             )
 
-        if not content:
-            raise Exception("CONTINUE")
-        return content
+        return content or ""
 
 
 class EventEmitter:
     def __init__(self, event_emitter: Callable[[dict], Any] = None):
         self.event_emitter = event_emitter
+        # the same event is updated and sent each time, this is safe as
+        # a single task sends them one after the other
+        self.status = {"status": "in_progress", "description": "", "done": False}
+        self.event = {"type": "status", "data": self.status}
+        # progress updates are queued and sent in the background so that
+        # the pipe does not wait for the UI, call flush() before exiting
+        self.queue = asyncio.Queue(maxsize=64)
+        self.task = None
 
     async def progress_update(self, description):
         await self.emit(description)
 
     async def error_update(self, description):
-        await self.emit(description, "error", True)
+        await self.emit_now(description, "error", True)
 
     async def success_update(self, description):
-        await self.emit(description, "success", True)
+        await self.emit_now(description, "success", True)
 
     async def emit(self, description="Unknown State", status="in_progress", done=False):
-        if self.event_emitter:
-            await self.event_emitter(
-                {
-                    "type": "status",
-                    "data": {
-                        "status": status,
-                        "description": description,
-                        "done": done,
-                    },
-                }
-            )
-
+        if not self.event_emitter:
+            return
+        if self.task is None:
+            self.task = asyncio.create_task(self.send_queued())
+        try:
+            self.queue.put_nowait((description, status, done))
+        except asyncio.QueueFull:
+            # drop the oldest update to keep the latest ones
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.queue.put_nowait((description, status, done))
+
+    async def emit_now(self, description, status, done):
+        "send the update once the queued ones are sent, used for final updates"
+        if not self.event_emitter:
+            return
+        await self.flush()
+        self.status["status"] = status
+        self.status["description"] = description
+        self.status["done"] = done
+        await self.event_emitter(self.event)
+
+    async def send_queued(self):
+        while True:
+            update = await self.queue.get()
+            # updates queued while the previous one was sent are outdated,
+            # only the latest of them is shown
+            n_updates = 1
+            while n_updates < 32 and not self.queue.empty():
+                update = self.queue.get_nowait()
+                n_updates += 1
+            description, status, done = update
+            try:
+                self.status["status"] = status
+                self.status["description"] = description
+                self.status["done"] = done
+                await self.event_emitter(self.event)
+            except Exception as e:
+                logger.warning("EventEmitter: error when emitting '%s': %s", description, e)
+            finally:
+                for _ in range(n_updates):
+                    self.queue.task_done()
+
+    async def flush(self):
+        "wait for the queued updates to be sent and stop the background task"
+        if self.task is None:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        self.task = None